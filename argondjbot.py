@@ -1,14 +1,55 @@
 #!/usr/bin/env python3
 import asyncio
-import datetime
+import collections
+import functools
+import itertools
+import logging
 import random
 import re
+import string
 import time
 
-import isodate
+import httpx
 import yaboli
-from apiclient.discovery import build
-from yaboli.util import asyncify, mention
+from yaboli.util import mention
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+# The subset of ISO 8601 durations the YouTube API returns, e.g. "PT1H2M3S" or "P1DT2H"
+_YT_DURATION_RE = re.compile(r"P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?")
+
+@functools.lru_cache(maxsize=4096)
+def _parse_yt_duration(s):
+	"""
+	Parse an ISO 8601 duration as returned by the YouTube API into seconds.
+
+	Only weeks, days, hours, minutes and seconds are supported, everything
+	else raises a ValueError.
+	"""
+
+	match = _YT_DURATION_RE.fullmatch(s)
+	if match is None:
+		raise ValueError(f"Invalid duration {s!r}")
+
+	weeks, days, hours, minutes, seconds = match.groups(0)
+	days = int(weeks) * 7 + int(days)
+	return (days * 24 + int(hours)) * 60*60 + int(minutes) * 60 + int(seconds)
+
+
+@functools.lru_cache(maxsize=256)
+def _mention_no_ping(nick):
+	"""
+	mention(nick, ping=False), cached since the same few people tend to
+	queue most of the videos.
+	"""
+
+	return mention(nick, ping=False)
 
 
 class Video:
@@ -17,80 +58,268 @@ class Video:
 	def __init__(self, vid, title, duration, blocked, allowed):
 		self.id = vid
 		self.title = title
-		self.raw_duration = isodate.parse_duration(duration)
-		self.duration = self.raw_duration + datetime.timedelta(seconds=self.DELAY)
+		# Durations are plain seconds so they can be added up without creating timedeltas
+		self.raw_duration_seconds = _parse_yt_duration(duration)
+		self.duration_seconds = self.raw_duration_seconds + self.DELAY
 		self.blocked = list(sorted(blocked)) if blocked is not None else None
 		self.allowed = list(sorted(allowed)) if allowed is not None else None
 
+		# Countries the video can't be watched in, precomputed for Playlist.format_list_entry
+		if allowed is not None:
+			blocked_countries = Playlist.COUNTRIES - frozenset(allowed)
+		elif blocked is not None:
+			blocked_countries = frozenset(blocked)
+		else:
+			blocked_countries = None
+
+		if blocked_countries is not None:
+			self.blocked_common = sorted(blocked_countries & Playlist.COMMON_COUNTRIES)
+			self.blocked_uncommon = sorted(blocked_countries - Playlist.COMMON_COUNTRIES)
+		else:
+			self.blocked_common = []
+			self.blocked_uncommon = []
+
 
 class YouTube:
+	API_URL = "https://www.googleapis.com/youtube/v3/videos"
+	MAX_IDS = 50 # Maximum number of ids per videos.list call
+	PART = "id,contentDetails,snippet"
+	FIELDS = "items(id,snippet/title,contentDetails/duration,contentDetails/regionRestriction)"
+	NO_RESTRICTION = {} # Shared default for videos without regionRestriction, never modified
+	CACHE_TTL = 60*60 # Seconds until a cached video is looked up again
+	FAILED_TTL = 60 # Seconds until a video the API didn't return is looked up again
+	BATCH_DELAY = 0.05 # Seconds to collect ids from concurrent lookups into one request
+
+	RETRIES = 3 # Attempts per request if the API is overloaded
+	RETRY_DELAY = 0.15 # Seconds, doubled after every attempt
+	RETRY_STATUS = {429, 500, 502, 503, 504}
+	TIMEOUT = 5.0 # Seconds, httpx's default made explicit. Timed out attempts are retried
+
 	def __init__(self, api_key):
-		self.service = build("youtube", "v3", developerKey=api_key)
+		self.api_key = api_key
+		self._http = httpx.AsyncClient(http2=True, timeout=self.TIMEOUT) # Keeps connections to the API open
+		self._cache = {} # video id -> (time fetched, Video)
+		self._failed = {} # video id -> time the API didn't return it
+		self._last_prune = time.monotonic()
+
+		self._pending = {} # video id -> future for the next batch, resolving to a Video or None
+		self._flush_handle = None
+		self._resolve_tasks = set() # Keeps running batches from being garbage collected
+
+	async def close(self):
+		# Abort batches that haven't been sent yet or are still running, so
+		# nothing uses the client after it is closed
+		if self._flush_handle is not None:
+			self._flush_handle.cancel()
+			self._flush_handle = None
+		pending, self._pending = self._pending, {}
+		for future in pending.values():
+			future.cancel()
+
+		for task in self._resolve_tasks:
+			task.cancel()
+		await asyncio.gather(*self._resolve_tasks, return_exceptions=True)
+
+		await self._http.aclose()
 
 	async def get_videos(self, vids):
-		vids = ",".join(vids)
-		query = self.service.videos().list(part="id,contentDetails,snippet", id=vids)
-		details = await asyncify(query.execute)
+		now = time.monotonic()
+		if now - self._last_prune >= self.CACHE_TTL:
+			self._prune(now)
+
+		videos = {}
+		missing = []
+		for vid in vids:
+			cached = self._cache.get(vid)
+			failed = self._failed.get(vid)
+			if cached is not None and now - cached[0] < self.CACHE_TTL:
+				videos[vid] = cached[1]
+			elif failed is None or now - failed >= self.FAILED_TTL:
+				missing.append(vid)
+
+		if missing:
+			new_videos = await self._fetch_batched(missing)
+			now = time.monotonic()
+			for vid in missing:
+				video = new_videos.get(vid)
+				if video is None:
+					self._failed[vid] = now
+				else:
+					self._cache[vid] = (now, video)
+					self._failed.pop(vid, None)
+			videos.update(new_videos)
+
+		return videos
+
+	def _prune(self, now):
+		"""
+		Forget expired entries so the caches don't grow with every video
+		ever queued.
+		"""
+
+		self._cache = {vid: entry for vid, entry in self._cache.items() if now - entry[0] < self.CACHE_TTL}
+		self._failed = {vid: failed for vid, failed in self._failed.items() if now - failed < self.FAILED_TTL}
+		self._last_prune = now
+
+	async def _fetch_batched(self, vids):
+		"""
+		Look up videos together with all other lookups started within
+		BATCH_DELAY, so that commands arriving at the same time share one
+		request.
+		"""
+
+		loop = asyncio.get_running_loop()
+		futures = {}
+		for vid in vids:
+			future = self._pending.get(vid)
+			if future is None:
+				future = loop.create_future()
+				self._pending[vid] = future
+			futures[vid] = future
+
+		if self._flush_handle is None:
+			self._flush_handle = loop.call_later(self.BATCH_DELAY, self._flush)
+
+		# Unlike gather, wait doesn't cancel the shared futures if we get cancelled
+		await asyncio.wait(futures.values())
+
+		# Look at every exception so asyncio doesn't complain about unretrieved ones
+		videos = {}
+		error = None
+		for vid, future in futures.items():
+			# The batch was aborted, which doesn't mean we were cancelled ourselves
+			if future.cancelled():
+				error = error or RuntimeError(f"Lookup of video {vid} was aborted")
+			elif future.exception() is not None:
+				error = error or future.exception()
+			elif future.result() is not None:
+				videos[vid] = future.result()
+
+		if error is not None:
+			raise error
+		return videos
+
+	def _flush(self):
+		self._flush_handle = None
+		pending, self._pending = self._pending, {}
+		task = asyncio.ensure_future(self._resolve(pending))
+		self._resolve_tasks.add(task)
+		task.add_done_callback(self._resolve_tasks.discard)
+
+	async def _resolve(self, pending):
+		try:
+			videos = await self._fetch_videos(list(pending))
+		except Exception as e:
+			for future in pending.values():
+				if not future.done():
+					future.set_exception(e)
+		else:
+			for vid, future in pending.items():
+				if not future.done():
+					future.set_result(videos.get(vid))
+		finally:
+			# Nobody else can settle these any more, so don't leave anyone waiting forever
+			for future in pending.values():
+				if not future.done():
+					future.cancel()
+
+	async def _fetch_videos(self, vids):
+		chunks = [vids[i:i + self.MAX_IDS] for i in range(0, len(vids), self.MAX_IDS)]
+		results = await asyncio.gather(*(self._fetch_chunk(chunk) for chunk in chunks))
+
+		videos = {}
+		for result in results:
+			videos.update(result)
+		return videos
+
+	async def _fetch_chunk(self, vids):
+		params = {
+			"key": self.api_key,
+			"part": self.PART,
+			"id": ",".join(vids),
+			"fields": self.FIELDS,
+		}
+		for attempt in range(self.RETRIES):
+			last_attempt = attempt == self.RETRIES - 1
+			try:
+				response = await self._http.get(self.API_URL, params=params)
+			except httpx.TransportError:
+				if last_attempt:
+					raise
+			else:
+				if last_attempt or response.status_code not in self.RETRY_STATUS:
+					break
+
+			delay = self.RETRY_DELAY * 2**attempt
+			await asyncio.sleep(delay + random.uniform(0, delay))
+
+		response.raise_for_status()
+		details = response.json()
 
+		# With a fields mask, "items" is left out entirely if no video was found
 		videos = {}
-		for info in details["items"]:
+		for info in details.get("items", []):
 			vid = info["id"]
-			title = info["snippet"]["title"]
-			duration = info["contentDetails"]["duration"]
-			blocked = info["contentDetails"].get("regionRestriction", {}).get("blocked", None)
-			allowed = info["contentDetails"].get("regionRestriction", {}).get("allowed", None)
+			content_details = info["contentDetails"]
+			restriction = content_details.get("regionRestriction", self.NO_RESTRICTION)
 
-			video = Video(vid, title, duration, blocked, allowed)
-			videos[vid] = video
+			videos[vid] = Video(
+				vid,
+				info["snippet"]["title"],
+				content_details["duration"],
+				restriction.get("blocked"),
+				restriction.get("allowed"),
+			)
 
 		return videos
 
 
 class Playlist:
-	COUNTRIES = { # according to en.wikipedia.org/wiki/ISO_3166-1_alpha-2, 2018-08-17 18:12:15 UTC
-		"AD", "AE", "AF", "AG", "AI", "AL", "AM", "AO", "AQ", "AR", "AS", "AT", "AU",
-		"AW", "AX", "AZ", "BA", "BB", "BD", "BE", "BF", "BG", "BH", "BI", "BJ", "BL",
-		"BM", "BN", "BO", "BQ", "BR", "BS", "BT", "BV", "BW", "BY", "BZ", "CA", "CC",
-		"CD", "CF", "CG", "CH", "CI", "CK", "CL", "CM", "CN", "CO", "CR", "CU", "CV",
-		"CW", "CX", "CY", "CZ", "DE", "DJ", "DK", "DM", "DO", "DZ", "EC", "EE", "EG",
-		"EH", "ER", "ES", "ET", "FI", "FJ", "FK", "FM", "FO", "FR", "GA", "GB", "GD",
-		"GE", "GF", "GG", "GH", "GI", "GL", "GM", "GN", "GP", "GQ", "GR", "GS", "GT",
-		"GU", "GW", "GY", "HK", "HM", "HN", "HR", "HT", "HU", "ID", "IE", "IL", "IM",
-		"IN", "IO", "IQ", "IR", "IS", "IT", "JE", "JM", "JO", "JP", "KE", "KG", "KH",
-		"KI", "KM", "KN", "KP", "KR", "KW", "KY", "KZ", "LA", "LB", "LC", "LI", "LK",
-		"LR", "LS", "LT", "LU", "LV", "LY", "MA", "MC", "MD", "ME", "MF", "MG", "MH",
-		"MK", "ML", "MM", "MN", "MO", "MP", "MQ", "MR", "MS", "MT", "MU", "MV", "MW",
-		"MX", "MY", "MZ", "NA", "NC", "NE", "NF", "NG", "NI", "NL", "NO", "NP", "NR",
-		"NU", "NZ", "OM", "PA", "PE", "PF", "PG", "PH", "PK", "PL", "PM", "PN", "PR",
-		"PS", "PT", "PW", "PY", "QA", "RE", "RO", "RS", "RU", "RW", "SA", "SB", "SC",
-		"SD", "SE", "SG", "SH", "SI", "SJ", "SK", "SL", "SM", "SN", "SO", "SR", "SS",
-		"ST", "SV", "SX", "SY", "SZ", "TC", "TD", "TF", "TG", "TH", "TJ", "TK", "TL",
-		"TM", "TN", "TO", "TR", "TT", "TV", "TW", "TZ", "UA", "UG", "UM", "US", "UY",
-		"UZ", "VA", "VC", "VE", "VG", "VI", "VN", "VU", "WF", "WS", "YE", "YT", "ZA",
-		"ZM", "ZW"
-	}
-	COMMON_COUNTRIES = {"DE", "FI", "FR", "GB", "IT", "JP", "NL", "PT", "US"}
+	COUNTRIES = frozenset(( # according to en.wikipedia.org/wiki/ISO_3166-1_alpha-2, 2018-08-17 18:12:15 UTC
+		"AD AE AF AG AI AL AM AO AQ AR AS AT AU "
+		"AW AX AZ BA BB BD BE BF BG BH BI BJ BL "
+		"BM BN BO BQ BR BS BT BV BW BY BZ CA CC "
+		"CD CF CG CH CI CK CL CM CN CO CR CU CV "
+		"CW CX CY CZ DE DJ DK DM DO DZ EC EE EG "
+		"EH ER ES ET FI FJ FK FM FO FR GA GB GD "
+		"GE GF GG GH GI GL GM GN GP GQ GR GS GT "
+		"GU GW GY HK HM HN HR HT HU ID IE IL IM "
+		"IN IO IQ IR IS IT JE JM JO JP KE KG KH "
+		"KI KM KN KP KR KW KY KZ LA LB LC LI LK "
+		"LR LS LT LU LV LY MA MC MD ME MF MG MH "
+		"MK ML MM MN MO MP MQ MR MS MT MU MV MW "
+		"MX MY MZ NA NC NE NF NG NI NL NO NP NR "
+		"NU NZ OM PA PE PF PG PH PK PL PM PN PR "
+		"PS PT PW PY QA RE RO RS RU RW SA SB SC "
+		"SD SE SG SH SI SJ SK SL SM SN SO SR SS "
+		"ST SV SX SY SZ TC TD TF TG TH TJ TK TL "
+		"TM TN TO TR TT TV TW TZ UA UG UM US UY "
+		"UZ VA VC VE VG VI VN VU WF WS YE YT ZA "
+		"ZM ZW"
+	).split())
+	COMMON_COUNTRIES = frozenset("DE FI FR GB IT JP NL PT US".split())
 
 	def __init__(self):
-		self.waiting = []
+		self.waiting = collections.deque()
+
+		# Cumulative durations (in seconds) of the waiting videos, kept in
+		# lockstep with self.waiting. The videos before position i take
+		# self._ends[i-1] - self._ends_offset seconds to play.
+		self._ends = collections.deque()
+		self._ends_offset = 0.0
 
 		self.playing_task = None
 		self.playing_video = None
 		self.playing_until = None
+		self._skip_event = asyncio.Event()
 
 	# formatting functions
 
 	@staticmethod
-	def format_duration(dt):
-		seconds = int(dt.total_seconds())
-
-		hours = seconds // (60*60)
-		seconds -= hours * (60*60)
-
-		minutes = seconds // 60
-		seconds -= minutes * 60
-
-		return f"{hours:02}:{minutes:02}:{seconds:02}"
+	def format_duration(seconds):
+		minutes, seconds = divmod(int(seconds), 60)
+		hours, minutes = divmod(minutes, 60)
+		return "%02d:%02d:%02d" % (hours, minutes, seconds)
 
 	@staticmethod
 	def format_list_entry(video, position=None, played_in=None):
@@ -103,51 +332,36 @@ class Playlist:
 			played_in = Playlist.format_duration(played_in)
 			info = f"{info} will be played in [{played_in}]"
 
-		#lines = [f"[{position:2}] {video.title!r} will be played in [{played_in}]"]
-		lines = [info]
-
-		blocked = None
-		if video.blocked is not None:
-			blocked = set(video.blocked)
-			#lines.append(f"Blocked in {', '.join(video.blocked)}.")
-		if video.allowed is not None:
-			blocked = Playlist.COUNTRIES - set(video.allowed)
-			#lines.append(f"Only viewable in {', '.join(video.allowed)}.")
-		if blocked is not None:
-			common = sorted(blocked & Playlist.COMMON_COUNTRIES)
-			uncommon = sorted(blocked - Playlist.COMMON_COUNTRIES)
-
-			if common:
-				if uncommon:
-					text = f"Blocked in {', '.join(common)} and {len(uncommon)} other "
-					text += "country." if len(uncommon) == 1 else "countries."
-				else:
-					text = f"Blocked in {', '.join(common)}."
-				lines.append(text)
-			elif uncommon:
-				if len(uncommon) <= 10:
-					text = f"Blocked in {', '.join(uncommon)}."
-				else:
-					text = f"Blocked in {len(uncommon)} "
-					text += "country." if len(uncommon) == 1 else "countries."
-				lines.append(text)
+		common = video.blocked_common
+		uncommon = video.blocked_uncommon
+
+		if common:
+			if uncommon:
+				text = f"Blocked in {', '.join(common)} and {len(uncommon)} other "
+				text += "country." if len(uncommon) == 1 else "countries."
+			else:
+				text = f"Blocked in {', '.join(common)}."
+			info = f"{info}\n{text}"
+		elif uncommon:
+			if len(uncommon) <= 10:
+				text = f"Blocked in {', '.join(uncommon)}."
+			else:
+				text = f"Blocked in {len(uncommon)} "
+				text += "country." if len(uncommon) == 1 else "countries."
+			info = f"{info}\n{text}"
 
-		return lines
+		return info
 
 	@staticmethod
 	def format_play(video, player):
-		raw_duration = Playlist.format_duration(video.raw_duration)
-		player = mention(player, ping=False)
-		lines = [
-			f"[{raw_duration}] {video.title!r} from {player}",
-			f"!play youtube.com/watch?v={video.id}",
-		]
-		return "\n".join(lines)
+		raw_duration = Playlist.format_duration(video.raw_duration_seconds)
+		player = _mention_no_ping(player)
+		return f"[{raw_duration}] {video.title!r} from {player}\n!play youtube.com/watch?v={video.id}"
 
 	@staticmethod
 	def format_next(video, player):
 		if video and player:
-			player = mention(player, ping=False)
+			player = _mention_no_ping(player)
 			return f"Next: {video.title!r} from {player}"
 		else:
 			return "Next: Nothing"
@@ -170,65 +384,103 @@ class Playlist:
 			return False
 
 	def skip(self, room):
-		if self.playing_task and not self.playing_task.done():
-			self.playing_task.cancel()
-			self.playing_task = None
-		self.play(room)
+		if self.playing():
+			self._skip_event.set()
+		else:
+			self.play(room)
 
 	async def _play(self, room):
 		"""
 		Plays videos from the queue until it is empty.
 		"""
 
-		while self.waiting:
-			video, player = self.waiting.pop(0)
-			duration = video.duration.total_seconds()
-
-			self.playing_video = video, player
-			self.playing_until = time.time() + duration
-
-			play_text = self.format_play(video, player)
-			#msg = await room.send(play_text)
-
-			next_video = self.next()
-			video, player = next_video if next_video else (None, None)
-			next_text = self.format_next(video, player)
-			#await room.send(next_text, msg.mid)
-
-			text = f"{play_text}\n{next_text}"
-			await room.send(text)
-
-			await asyncio.sleep(duration)
-
-		self.playing_task = None
-		self.playing_video = None
-		self.playing_until = None
+		try:
+			while self.waiting:
+				video, player = self.waiting.popleft()
+				self._ends_offset = self._ends.popleft()
+				duration = video.duration_seconds
+
+				self.playing_video = video, player
+				# Kept in the event loop's monotonic clock
+				self.playing_until = asyncio.get_running_loop().time() + duration
+
+				play_text = self.format_play(video, player)
+				#msg = await room.send(play_text)
+
+				next_video = self.next()
+				video, player = next_video if next_video else (None, None)
+				next_text = self.format_next(video, player)
+				#await room.send(next_text, msg.mid)
+
+				text = f"{play_text}\n{next_text}"
+				await room.send(text)
+
+				# Wait until the video is over or skip() is called
+				try:
+					await asyncio.wait_for(self._skip_event.wait(), timeout=duration)
+				except asyncio.TimeoutError:
+					pass
+				self._skip_event.clear()
+		finally:
+			# However we stop, a skip meant for this task mustn't carry over to the next one
+			self._skip_event.clear()
+			self.playing_task = None
+			self.playing_video = None
+			self.playing_until = None
 
 	# commands modifying the playlist
 
 	def insert(self, video, player, before=None):
 		element = (video, player)
-		if before is None:
+		seconds = video.duration_seconds
+
+		if before is None or before >= len(self.waiting):
 			position = len(self.waiting)
 			self.waiting.append(element)
-			return position
-		elif before >= 0:
-			self.waiting.insert(before, element)
-			return min(before, len(self.waiting) - 1)
+			self._ends.append((self._ends[-1] if self._ends else self._ends_offset) + seconds)
+		elif before == 0:
+			# Everything behind the new video moves back by its duration,
+			# which is the same as moving the offset forward
+			position = 0
+			self.waiting.appendleft(element)
+			self._ends.appendleft(self._ends_offset)
+			self._ends_offset -= seconds
+		elif before > 0:
+			position = before
+			self.waiting.insert(position, element)
+			self._ends.insert(position, self._ends[position - 1] + seconds)
+			for i in range(position + 1, len(self._ends)):
+				self._ends[i] += seconds
 		else:
 			return None
 
+		return position
+
 	def delete(self, position):
-		if position < 0:
+		if position < 0 or position >= len(self.waiting):
 			return None
 
-		try:
-			return self.waiting.pop(position)
-		except IndexError:
-			return None
+		if position == 0:
+			element = self.waiting.popleft()
+			self._ends_offset = self._ends.popleft()
+		elif position == len(self.waiting) - 1:
+			element = self.waiting.pop()
+			self._ends.pop()
+		else:
+			element = self.waiting[position]
+			del self.waiting[position]
+
+			seconds = element[0].duration_seconds
+			del self._ends[position]
+			for i in range(position, len(self._ends)):
+				self._ends[i] -= seconds
+
+		return element
 
 	def deleteall(self):
-		self.waiting = []
+		self.waiting.clear()
+		self._ends.clear()
+		self._ends_offset = 0.0
 
 	# playlist info
 
@@ -257,20 +509,20 @@ class Playlist:
 		return self.waiting[0] if self.waiting else None
 
 	def playtime_left(self):
-		if self.playing_until:
-			seconds = self.playing_until - time.time()
-			return datetime.timedelta(seconds=seconds)
+		if self.playing_until is not None:
+			return self.playing_until - asyncio.get_running_loop().time()
 		else:
-			return datetime.timedelta()
+			return 0.0
 
 	def playtime_until(self, position=None):
-		if position is None:
-			videos = self.waiting
-		else:
-			videos = self.waiting[:position]
+		if position is None or position > len(self._ends):
+			position = len(self._ends)
 
-		video_sum = sum((video.duration for video, _ in videos), datetime.timedelta())
-		return self.playtime_left() + video_sum
+		if position > 0:
+			seconds = self._ends[position - 1] - self._ends_offset
+		else:
+			seconds = 0
+		return self.playtime_left() + seconds
 
 
 class ArgonDJBot(yaboli.Bot):
@@ -295,13 +547,21 @@ class ArgonDJBot(yaboli.Bot):
 
 	# Find the video id in a single argument
 	VIDEO_ID_RE = r"[a-zA-Z0-9_-]{11}"
-	YOUTUBE_RE = r"((https?://)?(www\.|music\.)?(youtube\.com/((watch|listen)\?(\S*&)?v=|embed/)|youtu\.be/))?(" + VIDEO_ID_RE + ")"
+	VIDEO_ID_CHARS = frozenset(string.ascii_letters + string.digits + "_-")
+	YOUTUBE_RE = re.compile(r"((https?://)?(www\.|music\.)?(youtube\.com/((watch|listen)\?(\S*&)?v=|embed/)|youtu\.be/))?(" + VIDEO_ID_RE + ")")
 	YOUTUBE_RE_GROUP = 8
 
-	DEL_RE = r"(\d+)" # Per argument
-	INS_RE = r"(before|after)\s+(\d+)\s+(.*)" # On the whole argstr
+	# Common URL forms that can be handled without YOUTUBE_RE, see extract_video_id
+	URL_SCHEMES = ("https://", "http://")
+	URL_HOSTS = ("www.", "music.")
+	URL_PATHS = ("youtube.com/watch?v=", "youtu.be/", "youtube.com/embed/")
+
+	DEL_RE = re.compile(r"(\d+)") # Per argument
+	INS_RE = re.compile(r"(before|after)\s+(\d+)\s+(.*)") # On the whole argstr
+
+	LIST_MAX = 30 # Queue entries shown by !list, the rest are only counted
 
-	SKIP_VIDEOS = [
+	SKIP_VIDEOS = (
 		"-6BlMb7IFFY", # Plop: Plunger to bald head
 		"fClj2S6UzQA", # Ploop: Finger in metal cylinder
 		"OfkViWKucCU", # Sold pupper dance
@@ -356,15 +616,17 @@ class ArgonDJBot(yaboli.Bot):
 		"1s04tEDJVjY", # Smooth criminal cat
 		"P4JDgK6ib6Q", # Pigeon in river
 		"vJqiq0Feqng", # Charles Cornell quack
-	]
-	DRAMATICSKIP_VIDEOS = [
+	)
+	DRAMATICSKIP_VIDEOS = (
 		"VHkP88fx164", # animated video
 		"0pTOXwYtSVk", # longer video
 		"eVLOVpwXYGY", # dramatic chipmunk remix
 		"IqTerZkJaCU", # dramatic chipmunk vs shocked squirrel
 		"G4BuQ_0oU0I", # 8-bit chipmunk
 		"Wt0GiBkyCC0", # dramatic cat
-	] + ["y8Kyi0WNg40"]*100 # original video
+		"y8Kyi0WNg40", # original video
+	)
+	DRAMATICSKIP_WEIGHTS = (1, 1, 1, 1, 1, 1, 100) # Same order as DRAMATICSKIP_VIDEOS
 
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
@@ -408,20 +670,121 @@ class ArgonDJBot(yaboli.Bot):
 		self.yt = YouTube(self.config.get("argon", "api_key"))
 		self.playlist = Playlist()
 
+		self._skip_pool = {} # video id -> Video, for SKIP_VIDEOS and DRAMATICSKIP_VIDEOS
+		self._skip_videos = [] # SKIP_VIDEOS, as Video objects
+		self._dramaticskip_videos = [] # DRAMATICSKIP_VIDEOS, as Video objects
+		self._dramaticskip_cum_weights = [] # Cumulative DRAMATICSKIP_WEIGHTS of _dramaticskip_videos
+		self._skip_prefetch = None
+		self._start_skip_prefetch()
+
+	async def run(self, *args, **kwargs):
+		try:
+			await super().run(*args, **kwargs)
+		finally:
+			# Release the API connections however the bot stops
+			self._skip_prefetch.cancel()
+			await self.yt.close()
+
+	def _start_skip_prefetch(self):
+		# Keep a reference so the task isn't garbage collected while it runs
+		self._skip_prefetch = asyncio.ensure_future(self._prefetch_skip_videos())
+		self._skip_prefetch.add_done_callback(self._skip_prefetch_done)
+
+	@staticmethod
+	def _skip_prefetch_done(task):
+		if not task.cancelled() and task.exception() is not None:
+			logger.error("Could not prefetch skip videos", exc_info=task.exception())
+
+	async def _prefetch_skip_videos(self):
+		"""
+		Look up all skip videos in as few API calls as possible so the skip
+		commands don't have to wait for the API.
+		"""
+
+		vids = list(dict.fromkeys(self.SKIP_VIDEOS + self.DRAMATICSKIP_VIDEOS))
+		self._skip_pool.update(await self.yt.get_videos(vids))
+
+		# Update the lists in place since get_skip_video may be holding on to them
+		pool = self._skip_pool
+		self._skip_videos[:] = [pool[vid] for vid in self.SKIP_VIDEOS if vid in pool]
+		dramaticskip = [
+			(pool[vid], weight)
+			for vid, weight in zip(self.DRAMATICSKIP_VIDEOS, self.DRAMATICSKIP_WEIGHTS)
+			if vid in pool
+		]
+		self._dramaticskip_videos[:] = [video for video, _ in dramaticskip]
+		self._dramaticskip_cum_weights[:] = itertools.accumulate(weight for _, weight in dramaticskip)
+
+	async def get_skip_video(self, videos, cum_weights=None):
+		"""
+		Pick a random video from one of the prefetched skip video lists,
+		optionally weighted.
+
+		If the list is still empty, this waits for the running prefetch or,
+		if the last one failed, starts a new one, so a single batched lookup
+		serves this and all following skips.
+
+		Returns None if no skip video could be looked up.
+		"""
+
+		if not videos:
+			if self._skip_prefetch.done():
+				self._start_skip_prefetch()
+			# Unlike awaiting the task, wait doesn't cancel it if we get cancelled
+			await asyncio.wait([self._skip_prefetch])
+
+		if not videos:
+			return None
+		elif cum_weights is None:
+			return random.choice(videos)
+		else:
+			return random.choices(videos, cum_weights=cum_weights)[0]
+
+	@classmethod
+	def extract_video_id(cls, arg):
+		"""
+		Find the video id in a single argument the same way YOUTUBE_RE does.
+
+		Bare ids and the common URL forms are handled with plain string
+		operations, everything else falls back to the regex.
+
+		Returns None if no id was found.
+		"""
+
+		if len(arg) == 11 and cls.VIDEO_ID_CHARS.issuperset(arg):
+			return arg
+
+		rest = arg
+		for scheme in cls.URL_SCHEMES:
+			if rest.startswith(scheme):
+				rest = rest[len(scheme):]
+				break
+		for host in cls.URL_HOSTS:
+			if rest.startswith(host):
+				rest = rest[len(host):]
+				break
+		for path in cls.URL_PATHS:
+			if rest.startswith(path):
+				vid = rest[len(path):len(path) + 11]
+				# YOUTUBE_RE prefers a later "&v=" over the first "?v="
+				if len(vid) == 11 and cls.VIDEO_ID_CHARS.issuperset(vid) and "&v=" not in rest:
+					return vid
+				break
+
+		match = cls.YOUTUBE_RE.match(arg)
+		return match.group(cls.YOUTUBE_RE_GROUP) if match else None
+
 	async def find_videos(self, args):
-		video_ids = []
-		lines_parse_error = []
-		for arg in args:
-			if arg == "-id": continue
-			match = re.match(self.YOUTUBE_RE, arg)
-			if match:
-				video_ids.append(match.group(self.YOUTUBE_RE_GROUP))
-			else:
-				lines_parse_error.append(f"Could not parse {arg!r}")
+		parsed = [(self.extract_video_id(arg), arg) for arg in args if arg != "-id"]
+		video_ids = [vid for vid, _ in parsed if vid is not None]
+		lines_parse_error = [f"Could not parse {arg!r}" for vid, arg in parsed if vid is None]
+		if not video_ids:
+			return [], lines_parse_error, []
 
 		videos = []
 		lines_api_error = []
-		video_lookup = await self.yt.get_videos(video_ids)
+		# Queuing the same video twice is allowed, but it only needs to be looked up once
+		video_lookup = await self.yt.get_videos(list(dict.fromkeys(video_ids)))
 		for vid in video_ids:
 			video = video_lookup.get(vid)
 			if video:
@@ -435,73 +798,78 @@ class ArgonDJBot(yaboli.Bot):
 		videos, lines_parse_error, lines_api_error = await self.find_videos(args.basic())
 
 		if not videos:
-			text = "\n".join(lines_parse_error + lines_api_error)
+			text = "\n".join(itertools.chain(lines_parse_error, lines_api_error))
 			await msg.reply("ERROR: No valid videos specified\n" + text)
 			return
 
+		# The videos are appended, so each one starts when everything before it is over
+		until = self.playlist.playtime_until()
 		in_playlist = []
 		for video in videos:
 			position = self.playlist.insert(video, msg.sender.nick)
-			until = self.playlist.playtime_until(position)
 			in_playlist.append((video, position, until))
+			until += video.duration_seconds
 
 		lines = []
 
 		playing = self.playlist.play(room)
 		if playing:
 			video, _, _ = in_playlist[0]
-			info = Playlist.format_list_entry(video)
-			lines.extend(info)
+			lines.append(Playlist.format_list_entry(video))
 
 			in_playlist = [(v, p-1, u) for v, p, u in in_playlist[1:]]
 
 		for video, position, until in in_playlist:
-			info = Playlist.format_list_entry(video, position, until)
-			lines.extend(info)
+			lines.append(Playlist.format_list_entry(video, position, until))
 
-		text = "\n".join(lines + lines_parse_error + lines_api_error)
+		text = "\n".join(itertools.chain(lines, lines_parse_error, lines_api_error))
 		await msg.reply(text)
 
+	async def skip_to_random(self, room, msg, videos, cum_weights=None):
+		"""
+		Insert a random skip video at the front of the queue and skip to it.
+
+		The reply is sent while the video is being looked up (if it wasn't
+		prefetched yet) instead of afterwards.
+		"""
+
+		video, _ = await asyncio.gather(
+			self.get_skip_video(videos, cum_weights),
+			msg.reply("Skipping to next video"),
+		)
+		if video is not None:
+			self.playlist.insert(video, room.session.nick, before=0)
+		self.playlist.skip(room)
+
 	async def command_skip(self, room, msg, args):
 		if self.playlist.empty():
-			vid = random.choice(self.SKIP_VIDEOS)
-			videos = await self.yt.get_videos([vid])
-			video = videos.get(vid)
-			self.playlist.insert(video, room.session.nick, before=0)
+			await self.skip_to_random(room, msg, self._skip_videos)
+			return
 
 		await msg.reply("Skipping to next video")
 		self.playlist.skip(room)
 
 	async def command_vskip(self, room, msg, args):
-		vid = random.choice(self.SKIP_VIDEOS)
-		videos = await self.yt.get_videos([vid])
-		video = videos.get(vid)
-		self.playlist.insert(video, room.session.nick, before=0)
-
-		await msg.reply("Skipping to next video")
-		self.playlist.skip(room)
+		await self.skip_to_random(room, msg, self._skip_videos)
 
 	async def command_dskip(self, room, msg, args):
-		vid = random.choice(self.DRAMATICSKIP_VIDEOS)
-		videos = await self.yt.get_videos([vid])
-		video = videos.get(vid)
-		self.playlist.insert(video, room.session.nick, before=0)
-
-		await msg.reply("Skipping to next video")
-		self.playlist.skip(room)
+		await self.skip_to_random(room, msg, self._dramaticskip_videos, self._dramaticskip_cum_weights)
 
 	async def command_list(self, room, msg, args):
 		lines = []
 
 		if self.playlist.playing():
 			(video, _) = self.playlist.playing_video
-			info = Playlist.format_list_entry(video)
-			lines.extend(info)
+			lines.append(Playlist.format_list_entry(video))
+
+		until = self.playlist.playtime_left()
+		for position, (video, _) in itertools.islice(self.playlist.items(), self.LIST_MAX):
+			lines.append(Playlist.format_list_entry(video, position, until))
+			until += video.duration_seconds
 
-		for position, (video, _) in self.playlist.items():
-			until = self.playlist.playtime_until(position)
-			info = Playlist.format_list_entry(video, position, until)
-			lines.extend(info)
+		hidden = self.playlist.len() - self.LIST_MAX
+		if hidden > 0:
+			lines.append(f"... and {hidden} more")
 
 		if lines:
 			text = "\n".join(lines)
@@ -514,9 +882,9 @@ class ArgonDJBot(yaboli.Bot):
 		indices = []
 		lines_parse_error = []
 		for arg in args.basic():
-			match = re.match(r"\d+", arg)
+			match = self.DEL_RE.match(arg)
 			if match:
-				indices.append(int(match.group(0)))
+				indices.append(int(match.group(1)))
 			elif arg == "playing":
 				indices.append(-1)
 			else:
@@ -524,7 +892,7 @@ class ArgonDJBot(yaboli.Bot):
 
 		videos = []
 		lines_index_error = []
-		for i in sorted(set(indices)):
+		for i in sorted(dict.fromkeys(indices)):
 			video = self.playlist.get(i)
 			if video:
 				v, p = video
@@ -533,46 +901,44 @@ class ArgonDJBot(yaboli.Bot):
 				lines_index_error.append(f"No video at index {i}")
 
 		if not videos:
-			text = "\n".join(["ERROR: No valid indices given"] + lines_parse_error + lines_index_error)
+			text = "\n".join(itertools.chain(["ERROR: No valid indices given"], lines_parse_error, lines_index_error))
 			await msg.reply(text)
 			return
 
 		lines = []
 		for index, video, player in videos:
 			index = "playing" if index == -1 else index
-			info = []
-			info.append(f"[{index:2}] youtube.com/watch?v={video.id} {video.title!r}")
-			info.append(f"Queued by {mention(player, ping=False)}")
+			lines.append(f"[{index:2}] youtube.com/watch?v={video.id} {video.title!r}")
+			lines.append(f"Queued by {_mention_no_ping(player)}")
 
 			if video.blocked is not None:
-				info.append(f"Blocked in {', '.join(video.blocked)}.")
+				lines.append(f"Blocked in {', '.join(video.blocked)}.")
 			if video.allowed is not None:
-				info.append(f"Only viewable in {', '.join(video.allowed)}.")
+				lines.append(f"Only viewable in {', '.join(video.allowed)}.")
 
-			lines.extend(info)
 			lines.append("")
 
-		text = "\n".join(lines + lines_parse_error + lines_index_error)
+		text = "\n".join(itertools.chain(lines, lines_parse_error, lines_index_error))
 		await msg.reply(text)
 
 	async def command_delete(self, room, msg, args):
 		indices = []
 		lines_parse_error = []
 		for arg in args.basic():
-			match = re.fullmatch(self.DEL_RE, arg)
+			match = self.DEL_RE.fullmatch(arg)
 			if match:
 				indices.append(int(match.group(1)))
 			else:
 				lines_parse_error.append(f"Could not parse {arg!r}")
 
 		if not indices:
-			text = "\n".join(["ERROR: No valid indices given"] + lines_parse_error)
+			text = "\n".join(itertools.chain(["ERROR: No valid indices given"], lines_parse_error))
 			await msg.reply(text)
 			return
 
 		lines = []
 		lines_remove_error = []
-		for i in reversed(sorted(set(indices))):
+		for i in sorted(dict.fromkeys(indices), reverse=True):
 			success = self.playlist.delete(i)
 			if success:
 				video, _ = success
@@ -580,11 +946,11 @@ class ArgonDJBot(yaboli.Bot):
 			else:
 				lines_remove_error.append(f"No video at index {i}")
 
-		text = "\n".join(lines + lines_parse_error + lines_remove_error)
+		text = "\n".join(itertools.chain(lines, lines_parse_error, lines_remove_error))
 		await msg.reply(text)
 
 	async def command_insert(self, room, msg, args):
-		match = re.fullmatch(self.INS_RE, args.raw)
+		match = self.INS_RE.fullmatch(args.raw)
 		if not match:
 			await msg.reply("ERROR: Invalid command syntax")
 			return
@@ -596,23 +962,24 @@ class ArgonDJBot(yaboli.Bot):
 		videos, lines_parse_error, lines_api_error = await self.find_videos(args)
 
 		if not videos:
-			text = "\n".join(lines_parse_error + lines_api_error)
+			text = "\n".join(itertools.chain(lines_parse_error, lines_api_error))
 			await msg.reply("ERROR: No valid videos specified\n" + text)
 			return
 
 		if mode == "after":
 			before += 1
 
+		# The videos are inserted next to each other, so each one starts when the previous one is over
+		until = self.playlist.playtime_until(before)
 		lines = []
 		for video in videos:
 			position = self.playlist.insert(video, msg.sender.nick, before=before)
 			before += 1
-			until = self.playlist.playtime_until(position)
 
-			info = Playlist.format_list_entry(video, position, until)
-			lines.extend(info)
+			lines.append(Playlist.format_list_entry(video, position, until))
+			until += video.duration_seconds
 
-		text = "\n".join(lines + lines_parse_error + lines_api_error)
+		text = "\n".join(itertools.chain(lines, lines_parse_error, lines_api_error))
 		await msg.reply(text)
 		self.playlist.play(room)
 
@@ -621,7 +988,41 @@ class ArgonDJBot(yaboli.Bot):
 		await msg.reply("Queue deleted")
 
 
+class _OrjsonCodec:
+	"""
+	Drop-in for the json module that (de)serializes with orjson.
+
+	Keyword arguments meant for the json module are ignored.
+	"""
+
+	@staticmethod
+	def loads(s, **kwargs):
+		return orjson.loads(s)
+
+	@staticmethod
+	def dumps(obj, **kwargs):
+		return orjson.dumps(obj).decode()
+
+
+def use_orjson():
+	"""
+	Let yaboli parse and serialize euphoria packets with orjson if it is
+	installed. Only yaboli's connection module is patched, not the global
+	json module.
+
+	Returns True if orjson is being used, False otherwise.
+	"""
+
+	connection = getattr(yaboli, "connection", None)
+	if orjson is None or not hasattr(connection, "json"):
+		return False
+
+	connection.json = _OrjsonCodec
+	return True
+
+
 def main():
+	use_orjson()
 	yaboli.run(ArgonDJBot)
 
 if __name__ == "__main__":